@@ -0,0 +1,7 @@
+# gunicorn reads this file from the working directory: gunicorn simtrader_candle:app
+# one process: ticks, candles, market_open and the simulator thread all live in memory.
+# threaded worker: every open dashboard holds a thread on /api/stream, so keep threads
+# well above the number of concurrent dashboards.
+workers = 1
+worker_class = 'gthread'
+threads = 64
@@ -2,28 +2,61 @@
 """
 SimTrader - single-file Flask app with candlestick charts and robust DB initialization.
 Save as simtrader_candle.py
+Run with gunicorn simtrader_candle:app; gunicorn.conf.py pins one threaded worker, since
+state lives in process memory and each dashboard holds an open /api/stream connection.
 """
 
 import os
+import re
+import json
 import traceback
 import threading
 import time
 import random
 import sqlite3
+import pathlib
+import collections
+import itertools
+import queue
+import numpy as np
+import orjson
 from datetime import datetime
-from flask import Flask, request, jsonify, render_template_string, redirect, url_for, session, g
+from flask import Flask, request, jsonify, redirect, url_for, session
+from flask.json.provider import DefaultJSONProvider
 from flask_session import Session
+from flask_compress import Compress
+from werkzeug.security import generate_password_hash, check_password_hash
 
 # ---------------- app config ----------------
+class ORJSONProvider(DefaultJSONProvider):
+    # orjson serializes in C straight to bytes; jsonify() goes through response()
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default), mimetype=self.mimetype)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 app.secret_key = os.environ.get('FLASK_SECRET', 'replace-this-with-a-random-secret')
 app.config['SESSION_TYPE'] = 'filesystem'
+app.config['COMPRESS_STREAMS'] = False  # never buffer /api/stream behind the gzip encoder
 Session(app)
+Compress(app)
 
 MARKET_UPDATE_INTERVAL = 5.0  # seconds between ticks
 CANDLE_BUCKET = 60.0
+CANDLE_WINDOW = 120  # candles served to the dashboard chart
 PRICE_HISTORY_LENGTH = 500
+SEED_TICKS = 120  # ticks of synthetic history per symbol on first boot
+TICK_TRIM_EVERY = 50  # market ticks between trims of the persisted ticks table
 STARTING_CASH = 100000
+STREAM_QUEUE_SIZE = 64  # pending events per /api/stream subscriber before drops
+STREAM_KEEPALIVE = 15.0  # seconds of silence before a keepalive comment
 
 STOCKS = [
     {"symbol": "RELIANCE", "name": "Reliance Industries"},
@@ -42,6 +75,8 @@ STOCKS = [
     {"symbol": "SUNPHARMA", "name": "Sun Pharma"},
     {"symbol": "TATAMOTORS", "name": "Tata Motors"}
 ]
+STOCK_SYMBOLS = frozenset(s['symbol'] for s in STOCKS)
+STOCKS_JSON = json.dumps(STOCKS)
 
 # ---------------- robust DB path & immediate init ----------------
 DEFAULT_DB = 'simtrader.db'
@@ -58,28 +93,70 @@ except Exception:
 print('Using DB path:', DB_PATH)
 
 # ---------------- DB helpers ----------------
+# per-connection tuning; NORMAL skips the per-commit fsync that WAL makes unnecessary.
+# journal_mode=WAL is persistent in the db file, so init_db sets it once at startup.
+SQLITE_PRAGMAS = '''
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA mmap_size=268435456;
+PRAGMA cache_size=-65536;
+PRAGMA secure_delete=OFF;
+'''
+
+# statements written from more than one call site; one definition keeps their SQL from drifting
+# apart. (sqlite3 caches prepared statements per connection, keyed by the exact SQL text.)
+_SQL_INSERT_TICK = 'INSERT INTO ticks (symbol,ts,price) VALUES (?,?,?)'
+_SQL_INSERT_TRADE = 'INSERT INTO trades (user_id,symbol,shares,price,side,ts) VALUES (?,?,?,?,?,?)'
+_SQL_SET_META = 'REPLACE INTO metadata (key,value) VALUES (?,?)'
+SQL_STATEMENT_CACHE = 256  # per connection; comfortably above the app's distinct statements
+
+def open_db(readonly=False):
+    # every connection in the app goes through here: autocommit (transactions are explicit) + tuned PRAGMAs
+    if readonly:
+        db = sqlite3.connect(pathlib.Path(DB_PATH).as_uri() + '?mode=ro', uri=True, check_same_thread=False, isolation_level=None, cached_statements=SQL_STATEMENT_CACHE)
+    else:
+        db = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None, cached_statements=SQL_STATEMENT_CACHE)
+    db.executescript(SQLITE_PRAGMAS)
+    return db
+
+# connection pool: one writer shared by every thread, plus a read-only connection per thread.
+# WAL lets the readers run alongside the writer. writes must hold _WRITER_LOCK so one thread's
+# statements never land in another's open transaction.
+_WRITER = open_db()
+_WRITER.row_factory = sqlite3.Row
+_WRITER_LOCK = threading.Lock()
+_readers = threading.local()
+
 def get_db():
-    db = getattr(g, '_database', None)
+    db = getattr(_readers, 'db', None)
     if db is None:
-        db = g._database = sqlite3.connect(DB_PATH, check_same_thread=False)
+        db = _readers.db = open_db(readonly=True)
         db.row_factory = sqlite3.Row
     return db
 
-@app.teardown_appcontext
-def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+def get_write_db():
+    return _WRITER
 
 def init_db():
-    db = sqlite3.connect(DB_PATH)
+    db = open_db()
+    # WAL lets the simulator write while request threads read
+    db.execute('PRAGMA journal_mode=WAL')
     c = db.cursor()
+    # schema, default users and seed ticks commit together; the write lock also keeps another
+    # process opening the same file (e.g. the dev-server reloader) from seeding twice
+    c.execute('BEGIN IMMEDIATE')
     c.execute('''CREATE TABLE IF NOT EXISTS users (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         username TEXT UNIQUE,
-        password TEXT,
+        password_hash TEXT,
         cash REAL
     )''')
+    # older databases predate password_hash and still carry a plaintext password column
+    user_cols = {r[1] for r in c.execute('PRAGMA table_info(users)')}
+    if 'password_hash' not in user_cols:
+        c.execute('ALTER TABLE users ADD COLUMN password_hash TEXT')
+    # login looks users up by name alone; UNIQUE already implies this index, name it explicitly
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username ON users(username)')
     c.execute('''CREATE TABLE IF NOT EXISTS holdings (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER,
@@ -87,6 +164,8 @@ def init_db():
         shares INTEGER,
         avg_price REAL
     )''')
+    # one holdings row per (user, symbol); api_trade upserts against this
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS uq_holdings_user_symbol ON holdings(user_id, symbol)')
     c.execute('''CREATE TABLE IF NOT EXISTS trades (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER,
@@ -102,37 +181,42 @@ def init_db():
         ts REAL,
         price REAL
     )''')
+    # price reads are served from memory; the table is only bulk-loaded in ts order at startup and
+    # range-trimmed by ts, so one covering (ts, symbol, price) index serves both without table lookups
+    c.execute('CREATE INDEX IF NOT EXISTS idx_ticks_ts_cover ON ticks(ts, symbol, price)')
     c.execute('''CREATE TABLE IF NOT EXISTS metadata (
         key TEXT PRIMARY KEY,
         value TEXT
     )''')
-    db.commit()
 
-    # create users if not present
-    for i in range(1, 11):
-        try:
-            c.execute('INSERT INTO users (username,password,cash) VALUES (?,?,?)', (f'user{i}', f'pass{i}', STARTING_CASH))
-        except sqlite3.IntegrityError:
-            pass
-    try:
-        c.execute('INSERT INTO users (username,password,cash) VALUES (?,?,?)', ('admin', 'adminpass', STARTING_CASH))
-    except sqlite3.IntegrityError:
-        pass
-    db.commit()
+    # create users if not present (hashing is slow, so only for names that are missing)
+    users = [(f'user{i}', f'pass{i}') for i in range(1, 11)]
+    users.append(('admin', 'adminpass'))
+    existing = {r[0] for r in c.execute('SELECT username FROM users')}
+    c.executemany('INSERT INTO users (username,password_hash,cash) VALUES (?,?,?)',
+        [(u, generate_password_hash(p), STARTING_CASH) for u, p in users if u not in existing])
+    # hash any plaintext passwords left by older versions
+    if 'password' in user_cols:
+        legacy = c.execute('SELECT id, password FROM users WHERE password_hash IS NULL AND password IS NOT NULL').fetchall()
+        c.executemany('UPDATE users SET password_hash=?, password=NULL WHERE id=?',
+            [(generate_password_hash(p), i) for i, p in legacy])
 
     # seed ticks if empty
     c.execute('SELECT COUNT(*) as cnt FROM ticks')
     cnt = c.fetchone()[0]
     if cnt == 0:
         now = time.time()
+        ts = (now - (SEED_TICKS - np.arange(SEED_TICKS)) * MARKET_UPDATE_INTERVAL).tolist()
+        rows = []
         for s in STOCKS:
             base = random.uniform(800, 3500)
-            for i in range(120):
-                ts = now - (120 - i) * MARKET_UPDATE_INTERVAL
-                base = base * (1 + random.uniform(-0.0025, 0.0025))
-                c.execute('INSERT INTO ticks (symbol,ts,price) VALUES (?,?,?)', (s['symbol'], ts, round(base,2)))
-        c.execute('REPLACE INTO metadata (key,value) VALUES (?,?)', ('market_open', '1'))
-        db.commit()
+            prices = base * np.cumprod(1 + np.random.uniform(-0.0025, 0.0025, SEED_TICKS))
+            rows.extend(zip([s['symbol']] * SEED_TICKS, ts, np.round(prices, 2).tolist()))
+        c.executemany(_SQL_INSERT_TICK, rows)
+        c.execute(_SQL_SET_META, ('market_open', '1'))
+        # give the planner real statistics for the freshly seeded tables
+        c.execute('ANALYZE')
+    db.commit()
     db.close()
 
 # call init_db() now so tables exist under gunicorn before any request
@@ -145,85 +229,175 @@ except Exception:
     raise
 
 # ---------------- price helpers ----------------
-def append_tick(symbol, price, ts=None):
-    db = sqlite3.connect(DB_PATH)
+# in-memory tick history: per-symbol ring buffers of (timestamps, prices).
+# reads are served from here; the ticks table is only the durable copy.
+TICKS = {s['symbol']: (collections.deque(maxlen=PRICE_HISTORY_LENGTH), collections.deque(maxlen=PRICE_HISTORY_LENGTH)) for s in STOCKS}
+# per-symbol OHLC candles, maintained as ticks arrive; the last entry is the open candle
+CANDLES = {s['symbol']: collections.deque(maxlen=CANDLE_WINDOW) for s in STOCKS}
+# latest price per symbol; a plain dict so price lookups never wait on TICKS_LOCK
+LAST_PRICE = {}
+TICKS_LOCK = threading.Lock()  # guards TICKS and CANDLES
+
+def _update_candle(symbol, ts, price):
+    # caller holds TICKS_LOCK; ticks arrive in ts order, so only a bucket rollover needs the division
+    candles = CANDLES[symbol]
+    if candles and ts < candles[-1]['t'] + CANDLE_BUCKET:
+        cnd = candles[-1]
+        if price > cnd['high']:
+            cnd['high'] = price
+        elif price < cnd['low']:
+            cnd['low'] = price
+        cnd['close'] = price
+    else:
+        t = int(ts // CANDLE_BUCKET) * CANDLE_BUCKET
+        candles.append({'t': t, 'open': price, 'high': price, 'low': price, 'close': price})
+
+def load_ticks():
+    db = open_db()
     c = db.cursor()
+    c.execute('SELECT symbol,ts,price FROM ticks ORDER BY ts ASC')
+    rows = c.fetchall()
+    db.close()
+    with TICKS_LOCK:
+        for symbol, ts, price in rows:
+            buf = TICKS.get(symbol)
+            if buf is not None:
+                buf[0].append(ts)
+                buf[1].append(price)
+                _update_candle(symbol, ts, price)
+                LAST_PRICE[symbol] = price
+
+def append_tick(symbol, price, ts=None):
+    # in-memory only; market_tick persists a whole cycle in one transaction
     if ts is None:
         ts = time.time()
-    c.execute('INSERT INTO ticks (symbol,ts,price) VALUES (?,?,?)', (symbol, ts, round(price,2)))
-    c.execute('SELECT COUNT(*) as cnt FROM ticks WHERE symbol=?', (symbol,))
-    cnt = c.fetchone()[0]
-    if cnt > PRICE_HISTORY_LENGTH:
-        to_delete = cnt - PRICE_HISTORY_LENGTH
-        c.execute('DELETE FROM ticks WHERE id IN (SELECT id FROM ticks WHERE symbol=? ORDER BY ts ASC LIMIT ?)', (symbol, to_delete))
-    db.commit()
-    db.close()
+    price = round(price, 2)
+    with TICKS_LOCK:
+        ts_buf, px_buf = TICKS[symbol]
+        ts_buf.append(ts)
+        px_buf.append(price)
+        _update_candle(symbol, ts, price)
+        LAST_PRICE[symbol] = price
+    return price
+
+def trim_ticks(c):
+    # the ring buffers hold exactly the history worth keeping, so every persisted row older than
+    # their oldest entry goes in one range delete on idx_ticks_ts_cover
+    with TICKS_LOCK:
+        oldest = [buf[0][0] for buf in TICKS.values() if buf[0]]
+    if oldest:
+        c.execute('DELETE FROM ticks WHERE ts < ?', (min(oldest),))
 
 def get_latest_price(symbol):
-    db = sqlite3.connect(DB_PATH)
-    c = db.cursor()
-    c.execute('SELECT price FROM ticks WHERE symbol=? ORDER BY ts DESC LIMIT 1', (symbol,))
-    r = c.fetchone()
-    db.close()
-    return r[0] if r else None
+    return LAST_PRICE.get(symbol)
 
-def get_candles(symbol, limit=100):
-    db = sqlite3.connect(DB_PATH)
-    c = db.cursor()
-    cutoff = time.time() - limit * CANDLE_BUCKET
-    c.execute('SELECT ts,price FROM ticks WHERE symbol=? AND ts>=? ORDER BY ts ASC', (symbol, cutoff))
-    rows = c.fetchall()
-    db.close()
-    if not rows:
+def get_latest_prices():
+    return dict(LAST_PRICE)
+
+def get_candles(symbol, limit=CANDLE_WINDOW):
+    candles = CANDLES.get(symbol)
+    if candles is None:
         return []
-    candles = []
-    bucket = None
-    for r in rows:
-        ts = r[0]
-        price = r[1]
-        b = int(ts // CANDLE_BUCKET)
-        if bucket is None or b != bucket:
-            bucket = b
-            candles.append({'t': b * CANDLE_BUCKET, 'open': price, 'high': price, 'low': price, 'close': price})
-        else:
-            cnd = candles[-1]
-            cnd['high'] = max(cnd['high'], price)
-            cnd['low'] = min(cnd['low'], price)
-            cnd['close'] = price
-    return candles
+    cutoff = time.time() - limit * CANDLE_BUCKET
+    with TICKS_LOCK:
+        recent = list(candles)
+        if recent:
+            # the open candle keeps changing under the simulator; hand out a copy
+            recent[-1] = dict(recent[-1])
+    # candles are in time order: skip past any that fell out of the window (e.g. while the market was closed)
+    start = max(0, len(recent) - limit)
+    while start < len(recent) and recent[start]['t'] + CANDLE_BUCKET <= cutoff:
+        start += 1
+    return recent[start:]
+
+# warm the ring buffers from the persisted ticks table
+load_ticks()
+
+# ---------------- live updates (server-sent events) ----------------
+_SUBSCRIBERS = set()
+_SUBSCRIBERS_LOCK = threading.Lock()
+
+def publish(event, payload):
+    msg = f'event: {event}\ndata: {orjson.dumps(payload).decode()}\n\n'
+    with _SUBSCRIBERS_LOCK:
+        subscribers = list(_SUBSCRIBERS)
+    for q in subscribers:
+        try:
+            q.put_nowait(msg)
+        except queue.Full:
+            pass  # stalled client; it resyncs via refresh() when its stream reconnects
 
 # ---------------- market simulator ----------------
+_tick_count = 0
+_SIM_SYMBOLS = [s['symbol'] for s in STOCKS]
+_rng = np.random.default_rng()
+
+def _meta_body(market_open):
+    return orjson.dumps({'market_open': '1' if market_open else '0'})
+
+def load_market_open():
+    db = open_db()
+    row = db.execute("SELECT value FROM metadata WHERE key='market_open'").fetchone()
+    db.close()
+    return not (row and row[0] == '0')
+
+# market_open is read once at startup; afterwards only admin_toggle changes it (DB and
+# memory together, under _WRITER_LOCK). _META_BODY is the pre-encoded /api/meta payload.
+# like the tick buffers this is process state, which is why gunicorn.conf.py runs one worker.
+_MARKET_OPEN = load_market_open()
+_META_BODY = _meta_body(_MARKET_OPEN)
+
 def market_tick():
+    global _tick_count
     try:
-        db = sqlite3.connect(DB_PATH)
-        c = db.cursor()
-        c.execute('SELECT value FROM metadata WHERE key=?', ('market_open',))
-        row = c.fetchone()
-        open_flag = True
-        if row and row[0] == '0':
-            open_flag = False
-        if open_flag:
-            for s in STOCKS:
-                symbol = s['symbol']
-                c.execute('SELECT price FROM ticks WHERE symbol=? ORDER BY ts DESC LIMIT 1', (symbol,))
-                last_row = c.fetchone()
-                last = last_row[0] if last_row else random.uniform(800, 2000)
-                pct = random.gauss(0, 0.003)
-                if random.random() < 0.015:
-                    pct += random.gauss(0, 0.015)
-                newp = max(0.01, last * (1 + pct))
-                append_tick(symbol, newp)
-        db.close()
+        if _MARKET_OPEN:
+            now = time.time()
+            prices = get_latest_prices()
+            # one vectorized draw per cycle: gaussian drift plus an occasional larger jump
+            n = len(_SIM_SYMBOLS)
+            last = np.array([prices.get(symbol, np.nan) for symbol in _SIM_SYMBOLS])
+            missing = np.isnan(last)
+            last[missing] = _rng.uniform(800, 2000, missing.sum())
+            pct = _rng.normal(0, 0.003, n)
+            jump = _rng.random(n) < 0.015
+            pct[jump] += _rng.normal(0, 0.015, jump.sum())
+            new_prices = np.maximum(0.01, last * (1 + pct))
+            rows = [(symbol, now, append_tick(symbol, newp, now)) for symbol, newp in zip(_SIM_SYMBOLS, new_prices.tolist())]
+            db = get_write_db()
+            with _WRITER_LOCK, db:
+                c = db.cursor()
+                c.execute('BEGIN IMMEDIATE')
+                c.executemany(_SQL_INSERT_TICK, rows)
+                _tick_count += 1
+                if _tick_count % TICK_TRIM_EVERY == 0:
+                    trim_ticks(c)
+            publish('tick', {'ts': now, 'prices': {symbol: price for symbol, _, price in rows}})
     except Exception:
         print('market_tick error:')
         traceback.print_exc()
-    finally:
-        threading.Timer(MARKET_UPDATE_INTERVAL, market_tick).start()
 
-# start market simulator thread (single-shot start)
+def market_loop():
+    # fixed-rate schedule: sleep until the next deadline so handler time doesn't accumulate as drift
+    next_t = time.monotonic() + 1.0
+    while True:
+        dt = next_t - time.monotonic()
+        if dt > 0:
+            time.sleep(dt)
+        market_tick()
+        next_t += MARKET_UPDATE_INTERVAL
+        # after a stall (slow tick, suspended host) skip the missed slots instead of bursting to catch up
+        now = time.monotonic()
+        if next_t < now:
+            next_t = now
+
+# start market simulator thread (single-shot start). under the dev reloader (python simtrader_candle.py)
+# the parent process only watches files; only the serving child (WERKZEUG_RUN_MAIN set) runs the
+# simulator, so a single in-memory random walk writes the ticks table
+_RELOADER_PARENT = __name__ == '__main__' and not os.environ.get('WERKZEUG_RUN_MAIN')
 try:
-    threading.Timer(1.0, market_tick).start()
-    print('Market simulator thread started.')
+    if not _RELOADER_PARENT:
+        threading.Thread(target=market_loop, name='market-simulator', daemon=True).start()
+        print('Market simulator thread started.')
 except Exception:
     print('Error starting market simulator thread:')
     traceback.print_exc()
@@ -232,19 +406,28 @@ except Exception:
 def login_user_in_session(user_row):
     session['user_id'] = user_row['id']
     session['username'] = user_row['username']
+    session['is_admin'] = (user_row['username'] == 'admin')
 
 def current_user():
+    # sessions are server-side (Flask-Session), so the identity stashed at login is trusted;
+    # only a session without it (e.g. from an older build) costs a users lookup
     if 'user_id' not in session:
         return None
-    db = get_db()
-    c = db.cursor()
-    c.execute('SELECT * FROM users WHERE id=?', (session['user_id'],))
-    r = c.fetchone()
-    return r
+    if 'username' not in session:
+        db = get_db()
+        c = db.cursor()
+        c.execute('SELECT id, username FROM users WHERE id=?', (session['user_id'],))
+        r = c.fetchone()
+        if not r:
+            return None
+        login_user_in_session(r)
+    return {'id': session['user_id'], 'username': session['username'],
+            'is_admin': session.get('is_admin', session['username'] == 'admin')}
 
 # ---------------- templates (kept short) ----------------
 INDEX_HTML = """<!doctype html>
 <html><head><meta charset="utf-8"><title>SimTrader</title>
+<link rel="preconnect" href="https://cdn.jsdelivr.net" crossorigin>
 <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/css/bootstrap.min.css" rel="stylesheet">
 </head><body class="bg-light"><div class="container py-5">
 <div class="row justify-content-center"><div class="col-md-6"><div class="card shadow-sm"><div class="card-body">
@@ -256,6 +439,7 @@ INDEX_HTML = """<!doctype html>
 
 DASH_HTML = """<!doctype html>
 <html><head><meta charset="utf-8"><title>SimTrader</title>
+<link rel="preconnect" href="https://cdn.jsdelivr.net" crossorigin>
 <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/css/bootstrap.min.css" rel="stylesheet">
 <script src="https://cdn.jsdelivr.net/npm/chart.js"></script>
 <script src="https://cdn.jsdelivr.net/npm/chartjs-chart-financial@3.3.0/build/chartjs-chart-financial.min.js"></script>
@@ -283,38 +467,67 @@ DASH_HTML = """<!doctype html>
 </div></div>
 <script>
 const IS_ADMIN = {{ 'true' if is_admin else 'false' }};
+const SYMBOLS = {{ symbols_json|safe }};
 let currentSymbol = '{{first_symbol}}';
+const CANDLE_BUCKET = {{ candle_bucket }};
+const CANDLE_WINDOW = {{ candle_window }};
 async function fetchJSON(url, opts){ const r = await fetch(url, opts); if(!r.ok){ const t=await r.text(); throw new Error(t||r.statusText);} return r.json(); }
-async function loadSymbols(){ const data = await fetchJSON('/api/symbols'); const sel = document.getElementById('symbol'); sel.innerHTML=''; data.forEach(s=>{ const o=document.createElement('option'); o.value=s.symbol; o.textContent=s.symbol+' - '+s.name; sel.appendChild(o); }); sel.value=currentSymbol; }
-async function loadAccount(){ const data = await fetchJSON('/api/account'); document.getElementById('cash').textContent = data.cash.toFixed(2); const pdiv = document.getElementById('portfolio'); if(data.holdings.length===0) pdiv.innerHTML='<i>empty</i>'; else{ let html='<table class="table table-sm"><thead><tr><th>Symbol</th><th>Shares</th><th>Avg</th><th>Value</th></tr></thead><tbody>'; data.holdings.forEach(h=>{ html+=`<tr><td>${h.symbol}</td><td>${h.shares}</td><td>${h.avg_price.toFixed(2)}</td><td>${(h.shares*h.last_price).toFixed(2)}</td></tr>`; }); html+='</tbody></table>'; pdiv.innerHTML = html; } }
+function loadSymbols(){ const sel = document.getElementById('symbol'); sel.innerHTML=''; SYMBOLS.forEach(s=>{ const o=document.createElement('option'); o.value=s.symbol; o.textContent=s.symbol+' - '+s.name; sel.appendChild(o); }); sel.value=currentSymbol; }
+const lastPrices = {};
+let holdings = [];
+function renderPortfolio(){ const pdiv = document.getElementById('portfolio'); if(holdings.length===0) pdiv.innerHTML='<i>empty</i>'; else{ let html='<table class="table table-sm"><thead><tr><th>Symbol</th><th>Shares</th><th>Avg</th><th>Value</th></tr></thead><tbody>'; holdings.forEach(h=>{ const last = lastPrices[h.symbol] ?? h.last_price; html+=`<tr><td>${h.symbol}</td><td>${h.shares}</td><td>${h.avg_price.toFixed(2)}</td><td>${(h.shares*last).toFixed(2)}</td></tr>`; }); html+='</tbody></table>'; pdiv.innerHTML = html; } }
+async function loadAccount(){ const data = await fetchJSON('/api/account'); document.getElementById('cash').textContent = data.cash.toFixed(2); holdings = data.holdings; renderPortfolio(); }
 let candleChart;
-async function loadCandles(symbol){ const hist = await fetchJSON('/api/candles/'+symbol); const ohlc = hist.map(c=> ({o:c.open, h:c.high, l:c.low, c:c.close, t: new Date(c.t*1000)})); const ctx = document.getElementById('candleChart').getContext('2d'); if(!candleChart){ candleChart = new Chart(ctx, { type: 'candlestick', data: { datasets: [{ label: symbol, data: ohlc }] }, options: { animation:false, plugins: { legend:{display:false} }, scales: { x: { type: 'time', time: { unit: 'minute' } } } } }); } else { candleChart.data.datasets[0].data = ohlc; candleChart.data.datasets[0].label = symbol; candleChart.update(); } document.getElementById('prices').innerText = hist.slice(-10).map(c=> `${new Date(c.t*1000).toLocaleTimeString()} O:${c.open.toFixed(2)} H:${c.high.toFixed(2)} L:${c.low.toFixed(2)} C:${c.close.toFixed(2)}`).reverse().join('\\n'); }
-async function doTrade(){ const symbol=document.getElementById('symbol').value; const shares=Number(document.getElementById('shares').value); const side=document.getElementById('side').value; try{ const res = await fetchJSON('/api/trade', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({symbol,shares,side})}); document.getElementById('tradeResult').textContent = JSON.stringify(res); await loadAccount(); await loadCandles(symbol); }catch(e){ document.getElementById('tradeResult').textContent = 'Error: '+e.message; } }
+let candleEtag = null;
+let candleSymbol = null;
+let candleHist = [];
+function renderCandles(){ const ohlc = candleHist.map(c=> ({o:c.open, h:c.high, l:c.low, c:c.close, t: new Date(c.t*1000)})); const ctx = document.getElementById('candleChart').getContext('2d'); if(!candleChart){ candleChart = new Chart(ctx, { type: 'candlestick', data: { datasets: [{ label: candleSymbol, data: ohlc }] }, options: { animation:false, plugins: { legend:{display:false} }, scales: { x: { type: 'time', time: { unit: 'minute' } } } } }); } else { candleChart.data.datasets[0].data = ohlc; candleChart.data.datasets[0].label = candleSymbol; candleChart.update(); } document.getElementById('prices').innerText = candleHist.slice(-10).map(c=> `${new Date(c.t*1000).toLocaleTimeString()} O:${c.open.toFixed(2)} H:${c.high.toFixed(2)} L:${c.low.toFixed(2)} C:${c.close.toFixed(2)}`).reverse().join('\\n'); }
+async function loadCandles(symbol){ const r = await fetch('/api/candles/'+symbol); if(!r.ok){ const t=await r.text(); throw new Error(t||r.statusText);} const etag = r.headers.get('ETag'); if(etag && etag===candleEtag) return; candleEtag = etag; candleHist = await r.json(); candleSymbol = symbol; renderCandles(); }
+function applyTick(ts, price){ const t = Math.floor(ts/CANDLE_BUCKET)*CANDLE_BUCKET; const last = candleHist[candleHist.length-1]; if(last && last.t===t){ last.high=Math.max(last.high,price); last.low=Math.min(last.low,price); last.close=price; } else { candleHist.push({t:t, open:price, high:price, low:price, close:price}); if(candleHist.length>CANDLE_WINDOW) candleHist.shift(); } candleEtag = null; renderCandles(); }
+async function doTrade(){ const symbol=document.getElementById('symbol').value; const shares=Number(document.getElementById('shares').value); const side=document.getElementById('side').value; try{ const res = await fetchJSON('/api/trade', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({symbol,shares,side})}); document.getElementById('tradeResult').textContent = JSON.stringify(res); await loadAccount(); }catch(e){ document.getElementById('tradeResult').textContent = 'Error: '+e.message; } }
 document.getElementById('trade').addEventListener('click', ()=> doTrade());
 document.getElementById('symbol').addEventListener('change', (e)=>{ currentSymbol = e.target.value; document.getElementById('chartTitle').textContent = 'Price Chart - '+currentSymbol; loadCandles(currentSymbol); });
 document.getElementById('resetAll')?.addEventListener('click', async ()=>{ if(!confirm('Reset all users?')) return; await fetch('/admin/reset',{method:'POST'}); alert('Reset done'); });
 document.getElementById('toggleMarket')?.addEventListener('click', async ()=>{ const r=await fetch('/admin/toggle_market', {method:'POST'}); const t=await r.text(); alert(t); loadMeta(); });
-async function loadMeta(){ const m = await fetchJSON('/api/meta'); document.getElementById('marketState').textContent = m.market_open=='1'? 'Market Open':'Market Closed'; }
-async function refresh(){ try{ await loadSymbols(); await loadAccount(); await loadMeta(); await loadCandles(currentSymbol); }catch(e){ console.error(e); } }
-setInterval(()=>{ loadAccount(); loadCandles(currentSymbol); loadMeta(); }, 7000);
-loadSymbols().then(()=> refresh());
+function setMarketState(v){ document.getElementById('marketState').textContent = v=='1'? 'Market Open':'Market Closed'; }
+async function loadMeta(){ const m = await fetchJSON('/api/meta'); setMarketState(m.market_open); }
+async function refresh(){ try{ await loadAccount(); await loadMeta(); await loadCandles(currentSymbol); }catch(e){ console.error(e); } }
+// server pushes ticks/market state; resync with a full refresh whenever the stream reconnects
+const stream = new EventSource('/api/stream');
+let streamOpened = false;
+stream.onopen = ()=>{ if(streamOpened) refresh(); streamOpened = true; };
+stream.addEventListener('tick', (e)=>{ const m = JSON.parse(e.data); Object.assign(lastPrices, m.prices); renderPortfolio(); if(candleSymbol && m.prices[candleSymbol]!==undefined) applyTick(m.ts, m.prices[candleSymbol]); });
+stream.addEventListener('meta', (e)=> setMarketState(JSON.parse(e.data).market_open));
+stream.addEventListener('reset', ()=> loadAccount());
+loadSymbols(); refresh();
 </script></body></html>"""
 
+def _minify(html):
+    # drop inter-tag whitespace once at import; the pages are served on every login/dashboard hit
+    return re.sub(r'>\s+<', '><', html)
+
+INDEX_HTML = _minify(INDEX_HTML)
+DASH_HTML = _minify(DASH_HTML)
+
+# compile once at import instead of re-parsing the template source on every request
+_DASH_TMPL = app.jinja_env.from_string(DASH_HTML)
+
 # ---------------- routes & api ----------------
 @app.route('/')
 def index():
     if 'user_id' in session:
         return redirect(url_for('dashboard'))
-    return render_template_string(INDEX_HTML)
+    return INDEX_HTML  # no template variables, serve as-is
 
 @app.route('/login', methods=['POST'])
 def login():
     username = request.form.get('username')
     password = request.form.get('password')
     db = get_db(); c = db.cursor()
-    c.execute('SELECT * FROM users WHERE username=? AND password=?', (username, password))
+    # unique-index seek on username; the hash is checked in Python
+    c.execute('SELECT id, username, password_hash FROM users WHERE username=?', (username,))
     r = c.fetchone()
-    if not r:
+    if not r or not r['password_hash'] or not check_password_hash(r['password_hash'], password or ''):
         return 'Login failed', 401
     login_user_in_session(r)
     return redirect(url_for('dashboard'))
@@ -329,12 +542,23 @@ def dashboard():
     user = current_user()
     if not user:
         return redirect(url_for('index'))
-    is_admin = (user['username'] == 'admin')
-    return render_template_string(DASH_HTML, username=user['username'], is_admin=is_admin, first_symbol=STOCKS[0]['symbol'])
+    # page loads are rare next to API calls: confirm the session's user still exists
+    db = get_db(); c = db.cursor()
+    c.execute('SELECT 1 FROM users WHERE id=?', (user['id'],))
+    if c.fetchone() is None:
+        session.clear()
+        return redirect(url_for('index'))
+    return _DASH_TMPL.render(username=user['username'], is_admin=user['is_admin'], first_symbol=STOCKS[0]['symbol'], symbols_json=STOCKS_JSON, candle_bucket=CANDLE_BUCKET, candle_window=CANDLE_WINDOW)
+
+# STOCKS never changes: encode once and let browsers cache it.
+# a fresh Response is built per request since Flask-Session writes cookies onto it; for the
+# same reason it is private, so shared caches never store one user's session cookie.
+_SYMBOLS_BODY = STOCKS_JSON.encode()
+_SYMBOLS_HEADERS = {'Cache-Control': 'private, max-age=3600'}
 
 @app.route('/api/symbols')
 def api_symbols():
-    return jsonify(STOCKS)
+    return app.response_class(_SYMBOLS_BODY, mimetype='application/json', headers=_SYMBOLS_HEADERS)
 
 @app.route('/api/account')
 def api_account():
@@ -342,21 +566,56 @@ def api_account():
     if not user:
         return jsonify({'error':'not logged in'}), 401
     db = get_db(); c = db.cursor()
-    c.execute('SELECT cash FROM users WHERE id=?', (user['id'],))
-    cash = c.fetchone()['cash']
-    c.execute('SELECT symbol,shares,avg_price FROM holdings WHERE user_id=?', (user['id'],))
+    c.execute('SELECT u.cash, h.symbol, h.shares, h.avg_price FROM users u LEFT JOIN holdings h ON h.user_id=u.id WHERE u.id=?', (user['id'],))
+    rows = c.fetchall()
+    if not rows:
+        # session outlived its user row
+        session.clear()
+        return jsonify({'error':'not logged in'}), 401
+    cash = rows[0]['cash']
+    prices = get_latest_prices()
     holdings = []
-    for r in c.fetchall():
-        last = get_latest_price(r['symbol'])
-        holdings.append({'symbol': r['symbol'], 'shares': r['shares'], 'avg_price': r['avg_price'] or 0.0, 'last_price': last})
+    for r in rows:
+        if r['symbol'] is None:
+            continue
+        holdings.append({'symbol': r['symbol'], 'shares': r['shares'], 'avg_price': r['avg_price'] or 0.0, 'last_price': prices.get(r['symbol'])})
     return jsonify({'cash': cash, 'holdings': holdings})
 
+# always revalidate: the dashboard takes a full snapshot here and only adds pushed ticks on top,
+# so a stale body would leave gaps the stream never fills. unchanged windows still get a 304.
+_CANDLES_CACHE_CONTROL = 'private, no-cache'  # private: responses carry the session cookie
+
+# last encoded /api/candles body per symbol as (etag, bytes). every dashboard polling a symbol
+# between two ticks gets the same payload, so it is encoded once per change instead of per request
+_CANDLE_BODIES = {}
+
+def _candles_body(symbol, etag, candles):
+    cached = _CANDLE_BODIES.get(symbol)
+    if cached is not None and cached[0] == etag:
+        return cached[1]
+    body = orjson.dumps(candles)
+    _CANDLE_BODIES[symbol] = (etag, body)  # a racing duplicate encode is harmless: same bytes
+    return body
+
 @app.route('/api/candles/<symbol>')
 def api_candles(symbol):
-    if symbol not in [s['symbol'] for s in STOCKS]:
+    if symbol not in STOCK_SYMBOLS:
         return jsonify([])
-    candles = get_candles(symbol, limit=120)
-    return jsonify(candles)
+    candles = get_candles(symbol)
+    # only the open candle moves between polls, so the window bounds + its OHLC identify the payload
+    if candles:
+        last = candles[-1]
+        etag = f"{symbol}-{candles[0]['t']:.0f}-{len(candles)}-{last['high']}-{last['low']}-{last['close']}"
+    else:
+        etag = f'{symbol}-empty'
+    # weak validator: gzip and identity bodies are the same candles, and Flask-Compress leaves weak tags alone
+    if request.if_none_match.contains_weak(etag):
+        resp = app.response_class(status=304)
+    else:
+        resp = app.response_class(_candles_body(symbol, etag, candles), mimetype='application/json')
+    resp.set_etag(etag, weak=True)
+    resp.headers['Cache-Control'] = _CANDLES_CACHE_CONTROL
+    return resp
 
 @app.route('/api/trade', methods=['POST'])
 def api_trade():
@@ -371,65 +630,77 @@ def api_trade():
         return jsonify({'error':'invalid shares count'}), 400
     if side not in ('buy','sell'):
         return jsonify({'error':'invalid side'}), 400
-    if symbol not in [s['symbol'] for s in STOCKS]:
+    if symbol not in STOCK_SYMBOLS:
         return jsonify({'error':'unknown symbol'}), 400
     price = get_latest_price(symbol)
     if price is None:
         return jsonify({'error':'price not available'}), 500
-    db = get_db(); c = db.cursor()
-    if side == 'buy':
-        cost = price * shares
-        c.execute('SELECT cash FROM users WHERE id=?', (user['id'],))
-        cash = c.fetchone()['cash']
-        if cash < cost:
-            return jsonify({'error':'insufficient cash','required':cost,'available':cash}), 400
-        new_cash = cash - cost
-        c.execute('UPDATE users SET cash=? WHERE id=?', (new_cash, user['id']))
-        c.execute('SELECT id,shares,avg_price FROM holdings WHERE user_id=? AND symbol=?', (user['id'], symbol))
-        h = c.fetchone()
-        if h:
-            total_shares = h['shares'] + shares
-            total_cost = h['avg_price'] * h['shares'] + price * shares
-            new_avg = total_cost / total_shares
-            c.execute('UPDATE holdings SET shares=?, avg_price=? WHERE id=?', (total_shares, new_avg, h['id']))
-        else:
-            c.execute('INSERT INTO holdings (user_id,symbol,shares,avg_price) VALUES (?,?,?,?)', (user['id'], symbol, shares, price))
-        c.execute('INSERT INTO trades (user_id,symbol,shares,price,side,ts) VALUES (?,?,?,?,?,?)', (user['id'], symbol, shares, price, 'buy', datetime.utcnow().isoformat()))
-        db.commit()
-        return jsonify({'result':'bought','symbol':symbol,'price':price,'shares':shares,'cash':new_cash})
-    else:
-        c.execute('SELECT id,shares,avg_price FROM holdings WHERE user_id=? AND symbol=?', (user['id'], symbol))
-        h = c.fetchone()
-        if not h or h['shares'] < shares:
-            return jsonify({'error':'not enough shares to sell'}), 400
-        proceeds = price * shares
-        c.execute('SELECT cash FROM users WHERE id=?', (user['id'],))
-        cash = c.fetchone()['cash']
-        new_cash = cash + proceeds
-        c.execute('UPDATE users SET cash=? WHERE id=?', (new_cash, user['id']))
-        remaining = h['shares'] - shares
-        if remaining == 0:
-            c.execute('DELETE FROM holdings WHERE id=?', (h['id'],))
+    uid = user['id']
+    ts = datetime.utcnow().isoformat()
+    db = get_write_db(); c = db.cursor()
+    # one transaction per trade: BEGIN IMMEDIATE takes SQLite's write lock up front, the guarded
+    # UPDATEs make check+deduct atomic (checked via rowcount: RETURNING would need SQLite 3.35+),
+    # and 'with db' commits (or rolls back on any exception).
+    # only SQL runs under _WRITER_LOCK; the response is serialized after it is released.
+    with _WRITER_LOCK, db:
+        c.execute('BEGIN IMMEDIATE')
+        if side == 'buy':
+            cost = price * shares
+            c.execute('UPDATE users SET cash=cash-? WHERE id=? AND cash>=?', (cost, uid, cost))
+            deducted = c.rowcount == 1
+            c.execute('SELECT cash FROM users WHERE id=?', (uid,))
+            cur = c.fetchone()
+            if not deducted:
+                if cur is None:
+                    result = {'error':'not logged in'}, 401  # session outlived its user row
+                else:
+                    result = {'error':'insufficient cash','required':cost,'available':cur['cash']}, 400
+                db.rollback()
+            else:
+                c.execute("""INSERT INTO holdings (user_id,symbol,shares,avg_price) VALUES (?,?,?,?)
+                    ON CONFLICT(user_id,symbol) DO UPDATE SET
+                        shares=shares+excluded.shares,
+                        avg_price=(avg_price*shares+excluded.avg_price*excluded.shares)/(shares+excluded.shares)""",
+                    (uid, symbol, shares, price))
+                c.execute(_SQL_INSERT_TRADE, (uid, symbol, shares, price, 'buy', ts))
+                result = {'result':'bought','symbol':symbol,'price':price,'shares':shares,'cash':cur['cash']}, 200
         else:
-            c.execute('UPDATE holdings SET shares=? WHERE id=?', (remaining, h['id']))
-        c.execute('INSERT INTO trades (user_id,symbol,shares,price,side,ts) VALUES (?,?,?,?,?,?)', (user['id'], symbol, shares, price, 'sell', datetime.utcnow().isoformat()))
-        db.commit()
-        return jsonify({'result':'sold','symbol':symbol,'price':price,'shares':shares,'cash':new_cash})
+            c.execute('UPDATE holdings SET shares=shares-? WHERE user_id=? AND symbol=? AND shares>=?', (shares, uid, symbol, shares))
+            if c.rowcount == 0:
+                result = {'error':'not enough shares to sell'}, 400
+                db.rollback()
+            else:
+                c.execute('DELETE FROM holdings WHERE user_id=? AND symbol=? AND shares=0', (uid, symbol))
+                c.execute('UPDATE users SET cash=cash+? WHERE id=?', (price * shares, uid))
+                if c.rowcount == 0:
+                    result = {'error':'not logged in'}, 401  # session outlived its user row
+                    db.rollback()
+                else:
+                    c.execute('SELECT cash FROM users WHERE id=?', (uid,))
+                    cur = c.fetchone()
+                    c.execute(_SQL_INSERT_TRADE, (uid, symbol, shares, price, 'sell', ts))
+                    result = {'result':'sold','symbol':symbol,'price':price,'shares':shares,'cash':cur['cash']}, 200
+    payload, status = result
+    return jsonify(payload), status
 
 # admin endpoints
 def require_admin(user):
-    return user and user['username'] == 'admin'
+    return bool(user) and user['is_admin']
 
 @app.route('/admin/reset', methods=['POST'])
 def admin_reset():
     user = current_user()
     if not require_admin(user):
         return 'forbidden', 403
-    db = get_db(); c = db.cursor()
-    c.execute('DELETE FROM holdings')
-    c.execute('DELETE FROM trades')
-    c.execute('UPDATE users SET cash=?', (STARTING_CASH,))
-    db.commit()
+    db = get_write_db(); c = db.cursor()
+    # one transaction, one commit. unqualified DELETEs hit SQLite's truncate fast path, and
+    # secure_delete=OFF (see SQLITE_PRAGMAS) skips zeroing the freed pages
+    with _WRITER_LOCK, db:
+        c.execute('BEGIN IMMEDIATE')
+        c.execute('DELETE FROM holdings')
+        c.execute('DELETE FROM trades')
+        c.execute('UPDATE users SET cash=?', (STARTING_CASH,))
+    publish('reset', {})
     return 'ok'
 
 @app.route('/admin/toggle_market', methods=['POST'])
@@ -437,40 +708,59 @@ def admin_toggle():
     user = current_user()
     if not require_admin(user):
         return 'forbidden', 403
-    db = get_db(); c = db.cursor()
-    c.execute('SELECT value FROM metadata WHERE key=?', ('market_open',))
-    row = c.fetchone()
-    if not row or row['value'] == '1':
-        c.execute('REPLACE INTO metadata (key,value) VALUES (?,?)', ('market_open','0'))
-        db.commit()
-        return 'market closed'
-    else:
-        c.execute('REPLACE INTO metadata (key,value) VALUES (?,?)', ('market_open','1'))
-        db.commit()
-        return 'market opened'
+    global _MARKET_OPEN, _META_BODY
+    db = get_write_db()
+    with _WRITER_LOCK, db:
+        market_open = not _MARKET_OPEN
+        db.execute(_SQL_SET_META, ('market_open', '1' if market_open else '0'))
+        _MARKET_OPEN = market_open
+        _META_BODY = _meta_body(market_open)
+    publish('meta', {'market_open': '1' if market_open else '0'})
+    return 'market opened' if market_open else 'market closed'
 
 @app.route('/api/meta')
 def api_meta():
-    db = get_db(); c = db.cursor()
-    c.execute('SELECT value FROM metadata WHERE key=?', ('market_open',))
-    row = c.fetchone()
-    v = row['value'] if row else '1'
-    return jsonify({'market_open': v})
+    return app.response_class(_META_BODY, mimetype='application/json')
+
+@app.route('/api/stream')
+def api_stream():
+    if 'user_id' not in session:
+        return jsonify({'error':'not logged in'}), 401
+    q = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    def event_stream():
+        # subscribe only once the body is actually iterated: a generator closed before it starts
+        # (HEAD request, client gone before the first write) never runs its finally
+        try:
+            with _SUBSCRIBERS_LOCK:
+                _SUBSCRIBERS.add(q)
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    yield q.get(timeout=STREAM_KEEPALIVE)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+        finally:
+            with _SUBSCRIBERS_LOCK:
+                _SUBSCRIBERS.discard(q)
+    return app.response_class(event_stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/admin/users')
 def admin_users():
     user = current_user()
     if not require_admin(user):
         return jsonify({'error':'forbidden'}), 403
-    db = get_db(); c = db.cursor(); c.execute('SELECT id,username,cash FROM users')
+    db = get_db(); c = db.cursor()
+    # one pass over users joined to holdings (uq_holdings_user_symbol), grouped per user in Python
+    c.execute("""SELECT u.id, u.username, u.cash, h.symbol, h.shares
+        FROM users u LEFT JOIN holdings h ON h.user_id=u.id ORDER BY u.id""")
     out = []
-    for r in c.fetchall():
-        c.execute('SELECT symbol,shares FROM holdings WHERE user_id=?', (r['id'],))
-        holdings = [{'symbol':h['symbol'],'shares':h['shares']} for h in c.fetchall()]
-        out.append({'username': r['username'], 'cash': r['cash'], 'holdings': holdings})
+    for _, rows in itertools.groupby(c.fetchall(), key=lambda r: r['id']):
+        rows = list(rows)
+        holdings = [{'symbol':h['symbol'],'shares':h['shares']} for h in rows if h['symbol'] is not None]
+        out.append({'username': rows[0]['username'], 'cash': rows[0]['cash'], 'holdings': holdings})
     return jsonify(out)
 
 # ---------------- run (only for local dev) ----------------
 if __name__ == '__main__':
-    # local dev: make sure DB is initialized and start simulator (already started above)
+    # local dev: DB is initialized and the simulator started above (in the reloader's child only)
     app.run(debug=True, host='0.0.0.0')